@@ -1,15 +1,38 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from jinja2 import Template
+from lxml import etree
+from collections import deque, OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import configparser
-import xml.etree.ElementTree as ET
 import requests
+import threading
+import time
 import json
 import re
 from abc import ABC
 import abc
-import threading
 import psycopg2
+import psycopg2.pool
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Matches a WKT point and captures longitude and latitude
+_POINT_RE = re.compile(r'POINT\((-?\d+\.\d+) (-?\d+\.\d+)\)')
+
+# (connect, read) timeouts so a hung endpoint cannot stall a worker forever
+_TIMEOUT = (5, 30)
+
+# Retry transient server failures with exponential backoff
+_RETRIES = Retry(
+    total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+    allowed_methods=['GET']
+)
+
 class Model(ABC):
     """ Abstract class for defining the endpoints to search """
 
@@ -59,6 +82,50 @@ class RegisterModel(ABC):
         """
         raise NotImplementedError
 
+    def get_points(self, ids):
+        """
+        Get longitude and latitude for a collection of records by ID
+
+        :param ids: ids for the documents to decode
+        :type ids: list
+        :returns: mapping of id to (longitude, latitude); ids that fail are omitted
+        :rtype: dict
+        """
+        points = {}
+        for id in ids:
+            try:
+                points[id] = self.get_point(id)
+            except FetchPointError as fpe:
+                continue
+        return points
+
+    def iter_ids(self, batch=1, batch_size=10, stop=None):
+        """
+        Iterate batches of IDs using the register
+
+        A page whose retrieval fails is reported and skipped so one bad page
+        does not end the whole run.
+
+        :param batch: page to start getting items from
+        :param batch_size: number of items to retrieve per batch
+        :param stop: page to stop before, or None to run until exhausted
+        :type batch: integer
+        :type batch_size: integer
+        :type stop: integer
+        :returns: generator yielding lists of IDs
+        :rtype: generator
+        """
+        loop = True
+        while loop and (stop is None or batch < stop):
+            try:
+                identifiers, loop = self.get_ids(batch=batch, batch_size=batch_size)
+            except FetchIdBatchError as id_error:
+                print(id_error)
+                batch += 1
+                continue
+            yield identifiers
+            batch += 1
+
 class PIPError(Exception):
     """ Error when conducting Point in Polygon """
     pass
@@ -86,13 +153,32 @@ class WFSModel(Model):
         "%3C/Filter%3E&PropertyName={{ layer_id }}"
     )
 
+    # Template for WFS requests combining several points in one Or filter; the
+    # geometry is requested as well so features can be mapped back to points
+    _BATCH_URL_TEMPLATE = Template(
+        "{{ url }}?service=WFS&request=GetFeature&version=1.0.0&typeName={{ layer }}"
+        "&outputFormat=GML2&FILTER=%3CFilter%20xmlns=%22http://www.opengis.net/ogc%22"
+        "%20xmlns:gml=%22http://www.opengis.net/gml%22%3E%3COr%3E"
+        "{% for x, y in points %}"
+        "%3C{{ sf_function }}%3E%3CPropertyName%3E{{ geometry_field }}"
+        "%3C/PropertyName%3E%3Cgml:Point%20srsName=%22EPSG:4283%22%3E"
+        "%3Cgml:coordinates%3E{{ x }},{{ y }}%3C/gml:coordinates%3E%3C/gml:Point%3E"
+        "%3C/{{ sf_function }}%3E"
+        "{% endfor %}"
+        "%3C/Or%3E%3C/Filter%3E&PropertyName={{ layer_id }},{{ geometry_field }}"
+    )
+
+    # Maximum number of PIP results remembered between calls
+    _CACHE_SIZE = 100000
+
     _ns = None
     _url = None
     _layer = None
     _geometry_field = None
     _layer_id = None
 
-    def __init__(self, ns_short, ns_url, url, layer, geometry_field, layer_id):
+    def __init__(self, ns_short, ns_url, url, layer, geometry_field, layer_id,
+                 pool_size=10, sf_function=None):
         """
         Creator
 
@@ -108,6 +194,11 @@ class WFSModel(Model):
         :type geometry_field: string
         :param layer_id: Name of the identifier field (including prefix)
         :type layer_id: string
+        :param pool_size: Number of HTTP connections to keep alive
+        :type pool_size: integer
+        :param sf_function: Simple Features function to specialise the query
+            URL for when the whole run uses a fixed function
+        :type sf_function: string
         """
         self._ns = {
             'gml': 'http://www.opengis.net/gml',
@@ -118,31 +209,271 @@ class WFSModel(Model):
         self._layer = layer
         self._geometry_field = geometry_field
         self._layer_id = layer_id
+        # Resolve the namespaced tags once so the parsing loop avoids
+        # per-call prefix lookups against the namespace map
+        self._feature_member_tag = '{%s}featureMember' % self._ns['gml']
+        self._layer_tag = '{%s}%s' % (ns_url, layer.split(':')[-1])
+        self._layer_id_tag = '{%s}%s' % (ns_url, layer_id.split(':')[-1])
+        self._polygon_tag = './/{%s}Polygon' % self._ns['gml']
+        self._outer_ring_path = (
+            '{%s}outerBoundaryIs/{%s}LinearRing/{%s}coordinates'
+            % (self._ns['gml'], self._ns['gml'], self._ns['gml'])
+        )
+        self._inner_ring_path = (
+            '{%s}innerBoundaryIs/{%s}LinearRing/{%s}coordinates'
+            % (self._ns['gml'], self._ns['gml'], self._ns['gml'])
+        )
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=_RETRIES
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._cache = OrderedDict()
+        # In-flight futures so concurrent requests for the same key collapse
+        # into a single HTTP call; the lock guards both the futures map and
+        # the result cache, which worker threads share
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Render the template once with the invariant parts baked in so the
+        # hot path only performs a str.format substitution
+        self._url_fmt = self._URL_TEMPLATE.render(
+            url=url, layer=layer, geometry_field=geometry_field,
+            layer_id=layer_id, sf_function='{sf_function}', x='{x}', y='{y}'
+        )
+        # Specialise further when the function is fixed for the whole run,
+        # leaving only the coordinates to substitute per call
+        self._sf_function = sf_function
+        if sf_function is not None:
+            self._url_fmt_fixed = self._URL_TEMPLATE.render(
+                url=url, layer=layer, geometry_field=geometry_field,
+                layer_id=layer_id, sf_function=sf_function, x='{x}', y='{y}'
+            )
 
 
     def obtain_id(self, x, y, sf_function):
+        key = (round(float(x), 6), round(float(y), 6), sf_function)
+        with self._inflight_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            future = self._inflight.get(key)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            # Another thread is already fetching this key; await its result
+            return future.result()
+        try:
+            id = self._request_id(x, y, sf_function)
+        except Exception as pe:
+            future.set_exception(pe)
+            with self._inflight_lock:
+                del self._inflight[key]
+            raise
+        with self._inflight_lock:
+            self._cache[key] = id
+            if len(self._cache) > self._CACHE_SIZE:
+                self._cache.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(id)
+        return id
+
+    def _request_id(self, x, y, sf_function):
+        """
+        Issue the WFS request for a single point and parse the identifier
+
+        :param x: longitude of the point
+        :param y: latitude of the point
+        :type x: double
+        :type y: double
+        :param sf_function: The name of the Simple Features function e.g., Contains
+        :type sf_function: string
+        :returns: identifier
+        :rtype: string
+        :raises PIPError: raised when PIP fails and no XML result is received
+        """
         id = None
-        query_url = self._URL_TEMPLATE.render(
+        if sf_function == self._sf_function:
+            query_url = self._url_fmt_fixed.format(x=x, y=y)
+        else:
+            query_url = self._url_fmt.format(sf_function=sf_function, x=x, y=y)
+        try:
+            with self._session.get(query_url, stream=True, timeout=_TIMEOUT) as response:
+                response.raw.decode_content = True
+                for event, item in etree.iterparse(
+                        response.raw, tag=self._feature_member_tag
+                ):
+                    feature = item.find(self._layer_tag)
+                    id = feature.find(self._layer_id_tag).text
+                    item.clear()
+                    while item.getprevious() is not None:
+                        del item.getparent()[0]
+        except (etree.XMLSyntaxError, requests.exceptions.RequestException) as pe:
+            raise PIPError("PIP FAILED")
+        return id
+
+    def obtain_ids(self, points, sf_function):
+        """
+        Obtain polygon layer identifiers for several points with one WFS request
+
+        The point filters are combined in a single Or filter and the returned
+        polygon geometries are tested locally to map each feature back to the
+        points it contains.
+
+        :param points: (point_id, x, y) triples to resolve
+        :type points: list
+        :param sf_function: The name of the Simple Features function e.g., Contains
+        :type sf_function: string
+        :returns: mapping of point_id to identifier (None when no polygon matched)
+        :rtype: dict
+        :raises PIPError: raised when PIP fails and no XML result is received
+        """
+        ids = {}
+        pending = []
+        with self._inflight_lock:
+            for point_id, x, y in points:
+                key = (round(float(x), 6), round(float(y), 6), sf_function)
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    ids[point_id] = self._cache[key]
+                else:
+                    pending.append((point_id, float(x), float(y)))
+        if not pending:
+            return ids
+        if len(pending) == 1:
+            point_id, x, y = pending[0]
+            ids[point_id] = self.obtain_id(x=x, y=y, sf_function=sf_function)
+            return ids
+        query_url = self._BATCH_URL_TEMPLATE.render(
             url=self._url, layer=self._layer, geometry_field=self._geometry_field,
-            layer_id=self._layer_id, x=x, y=y, sf_function=sf_function
+            layer_id=self._layer_id, sf_function=sf_function,
+            points=[(x, y) for point_id, x, y in pending]
         )
+        matched = {}
         try:
-            response = requests.get(query_url)
-            root = ET.fromstring(response.text)
-            for item in root.findall('gml:featureMember', self._ns):
-                feature = item.find(self._layer, self._ns)
-                id = feature.find(self._layer_id, self._ns).text
-        except ET.ParseError as pe:
+            with self._session.get(query_url, stream=True, timeout=_TIMEOUT) as response:
+                response.raw.decode_content = True
+                for event, item in etree.iterparse(
+                        response.raw, tag=self._feature_member_tag
+                ):
+                    feature = item.find(self._layer_tag)
+                    id = feature.find(self._layer_id_tag).text
+                    for point_id, x, y in pending:
+                        if point_id not in matched and \
+                                self._feature_contains(feature, x, y):
+                            matched[point_id] = id
+                    item.clear()
+                    while item.getprevious() is not None:
+                        del item.getparent()[0]
+        except (etree.XMLSyntaxError, requests.exceptions.RequestException) as pe:
             raise PIPError("PIP FAILED")
-        return id
+        with self._inflight_lock:
+            for point_id, x, y in pending:
+                id = matched.get(point_id)
+                # An unmatched point may just have eluded the local
+                # re-association, so only matched results are safe to remember
+                if id is not None:
+                    self._cache[(round(x, 6), round(y, 6), sf_function)] = id
+                    if len(self._cache) > self._CACHE_SIZE:
+                        self._cache.popitem(last=False)
+                ids[point_id] = id
+        return ids
+
+    def _feature_contains(self, feature, x, y):
+        """
+        Test whether a point lies inside any polygon member of a feature
+
+        Every polygon of a MultiPolygon feature is considered: the point is
+        contained when it falls inside a member's outer ring without falling
+        inside any of that member's interior rings (holes).
+
+        :param feature: the feature element parsed from the WFS response
+        :type feature: lxml.etree._Element
+        :param x: longitude of the point
+        :type x: double
+        :param y: latitude of the point
+        :type y: double
+        :returns: whether the feature contains the point
+        :rtype: boolean
+        """
+        for polygon in feature.findall(self._polygon_tag):
+            outer = polygon.find(self._outer_ring_path)
+            if outer is None or \
+                    not self._point_in_polygon(x, y, self._parse_ring(outer.text)):
+                continue
+            inside = True
+            for inner in polygon.findall(self._inner_ring_path):
+                if self._point_in_polygon(x, y, self._parse_ring(inner.text)):
+                    inside = False
+                    break
+            if inside:
+                return True
+        return False
+
+    @staticmethod
+    def _parse_ring(text):
+        """
+        Parse a gml:coordinates string into (x, y) vertex pairs
+
+        :param text: whitespace-separated x,y coordinate pairs
+        :type text: string
+        :returns: (x, y) pairs forming the ring
+        :rtype: list
+        """
+        return [
+            tuple(float(value) for value in pair.split(','))
+            for pair in text.split()
+        ]
+
+    @staticmethod
+    def _point_in_polygon(x, y, vertices):
+        """
+        Test point containment against a polygon boundary using ray casting
+
+        :param x: longitude of the point
+        :type x: double
+        :param y: latitude of the point
+        :type y: double
+        :param vertices: (x, y) pairs forming the ring
+        :type vertices: list
+        :returns: whether the point lies inside the boundary
+        :rtype: boolean
+        """
+        inside = False
+        previous = len(vertices) - 1
+        for current in range(len(vertices)):
+            xi, yi = vertices[current]
+            xj, yj = vertices[previous]
+            if (yi > y) != (yj > y) and \
+                    x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            previous = current
+        return inside
 
 class DBModel(RegisterModel):
     """ Database endpoint to use as an index """
 
+    # Server-side statements prepared lazily on each pooled connection so
+    # repeated single-row lookups skip the parse and plan steps
+    _PREPARE_STATEMENTS = [
+        (
+            "PREPARE gnaf_get_point AS "
+            "SELECT longitude, latitude "
+            "FROM gnaf.address_default_geocode "
+            "WHERE address_detail_pid = $1"
+        )
+    ]
+
     _connection_string = None
+    _pool = None
     _count = 0
 
-    def __init__(self, endpoint, initialiser="SELECT count(*) FROM gnaf.address_detail"):
+    def __init__(self, endpoint, initialiser="SELECT count(*) FROM gnaf.address_detail",
+                 connections=10):
         """
         Creator
 
@@ -150,19 +481,20 @@ class DBModel(RegisterModel):
         :type endpoint: string
         :param initialiser: Query used to count the number of records to process
         :type initialiser: string
+        :param connections: Maximum number of pooled database connections
+        :type connections: integer
         """
         self._connection_string = endpoint
         try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=1, maxconn=connections, dsn=endpoint
+            )
             row = self.run_query(query=initialiser, parameters=(id,), get_all=False)
             self._count = int(row[0])
         except Exception as ce:
-            raise InitialisationError(id)
+            raise InitialisationError(endpoint)
 
-    def get_point(self, id, select_statement = (
-            "SELECT longitude, latitude "
-            "FROM gnaf.address_default_geocode "
-            "WHERE address_detail_pid = %s"
-    )):
+    def get_point(self, id, select_statement = "EXECUTE gnaf_get_point (%s)"):
         x = None
         y = None
         try:
@@ -173,6 +505,26 @@ class DBModel(RegisterModel):
             raise FetchPointError(id)
         return x, y
         
+    def get_points(self, ids, select_statement = (
+            "SELECT address_detail_pid, longitude, latitude "
+            "FROM gnaf.address_default_geocode "
+            "WHERE address_detail_pid = ANY(%s)"
+    )):
+        """
+        Get longitude and latitude for a collection of records with one query
+
+        :param ids: ids for the documents to decode
+        :type ids: list
+        :returns: mapping of id to (longitude, latitude); ids that fail are omitted
+        :rtype: dict
+        :raises FetchPointError: raised when the batched query fails
+        """
+        try:
+            rows = self.run_query(query=select_statement, parameters=(list(ids),))
+        except Exception as ce:
+            raise FetchPointError(list(ids))
+        return {row[0]: (row[1], row[2]) for row in rows}
+
     def get_ids(self, batch=1, batch_size=10, select_statement = (
             "SELECT address_detail_pid "
             "FROM gnaf.address_detail "
@@ -187,10 +539,58 @@ class DBModel(RegisterModel):
             raise FetchIdBatchError(select_statement)
         return [row[0] for row in rows], (batch_size*batch) < self._count
 
+    def iter_ids(self, batch=1, batch_size=10, stop=None, select_statement = (
+            "SELECT address_detail_pid "
+            "FROM gnaf.address_detail "
+            "ORDER BY address_detail_pid "
+    )):
+        """
+        Iterate batches of IDs streamed from a server-side cursor
+
+        Streams the whole listing with a single query rather than issuing a
+        LIMIT/OFFSET query per page, which makes the server re-scan every
+        skipped row on each call.
+
+        :param batch: page to start getting items from
+        :param batch_size: number of items to retrieve per batch
+        :param stop: page to stop before, or None to run until exhausted
+        :type batch: integer
+        :type batch_size: integer
+        :type stop: integer
+        :returns: generator yielding lists of IDs
+        :rtype: generator
+        :raises FetchIdBatchError: raised when the streaming query fails
+        """
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor(name='joiner_ids') as cur:
+                cur.itersize = batch_size
+                cur.execute(select_statement)
+                page = 1
+                while page < batch:
+                    if not cur.fetchmany(batch_size):
+                        return
+                    page += 1
+                while stop is None or page < stop:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [row[0] for row in rows]
+                    page += 1
+        except psycopg2.Error as ce:
+            raise FetchIdBatchError(select_statement)
+        finally:
+            self._pool.putconn(conn)
+
     def run_query(self, query, parameters=None, get_all=True):
         """
         Run a query
 
+        When the query references a server-side prepared statement that does
+        not exist on the borrowed connection yet, the PREPARE statements are
+        issued on that connection and the query retried once, so connections
+        recycled by the pool heal themselves.
+
         :param query: Query to execute
         :type query: string
         :param parameters: Parameters to issue to query
@@ -201,21 +601,56 @@ class DBModel(RegisterModel):
         :rtype: list
         """
         rows = None
-        conn = psycopg2.connect(self._connection_string)
-        cur = conn.cursor()
-        cur.execute(query, parameters)
-        if get_all:
-            rows = cur.fetchall()
-        else:
-            rows = cur.fetchone()
+        conn = self._pool.getconn()
+        try:
+            try:
+                rows = self._execute(conn, query, parameters, get_all)
+            except psycopg2.errors.InvalidSqlStatementName as pe:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    for statement in self._PREPARE_STATEMENTS:
+                        cur.execute(statement)
+                rows = self._execute(conn, query, parameters, get_all)
+            conn.commit()
+        finally:
+            self._pool.putconn(conn)
         return rows
 
+    def _execute(self, conn, query, parameters, get_all):
+        """
+        Execute a query on a borrowed connection and fetch the results
+
+        :param conn: Connection borrowed from the pool
+        :type conn: psycopg2 connection
+        :param query: Query to execute
+        :type query: string
+        :param parameters: Parameters to issue to query
+        :type parameters: tuple
+        :param get_all: IF true THEN fetchall ELSE fetchone
+        :type get_all: boolean
+        :return: results of the cursor fetch
+        :rtype: list
+        """
+        with conn.cursor() as cur:
+            cur.execute(query, parameters)
+            if get_all:
+                return cur.fetchall()
+            return cur.fetchone()
+
+    def close(self):
+        """
+        Close all pooled database connections
+
+        :return: None
+        """
+        self._pool.closeall()
+
 class LDAPIModel(RegisterModel):
     """ WFS endpoint to use as an index """
 
     _endpoint_url = None
 
-    def __init__(self, endpoint, initialiser=None):
+    def __init__(self, endpoint, initialiser=None, pool_size=10):
         """
         Creator
 
@@ -223,49 +658,147 @@ class LDAPIModel(RegisterModel):
         :type endpoint: string
         :param initialiser: Task or string used to prepare the endpoint - currently unused
         :type initialiser: string
+        :param pool_size: Number of HTTP connections to keep alive
+        :type pool_size: integer
         """
         self._endpoint_url = endpoint
+        self._session = requests.Session()
+        self._session.headers.update({'Accept': 'application/json'})
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=_RETRIES
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
 
     def get_point(self, id):
         x = None
         y = None
         try:
-            response = requests.get(id, headers={'Accept': 'application/json'})
-            m = re.search('POINT\(-?\d+\.\d+ -?\d+\.\d+\)', response.text)
+            response = self._session.get(id, timeout=_TIMEOUT)
+            m = _POINT_RE.search(response.text)
             if m:
-                m2 = re.search('-?\d+\.\d+ -?\d+\.\d+', m.group(0))
-                if m2:
-                    coordinates = m2.group(0).split(' ')
-                    x = coordinates[0]
-                    y = coordinates[1]
-        except requests.exceptions.ConnectionError as ce:
+                x = m.group(1)
+                y = m.group(2)
+        except requests.exceptions.RequestException as ce:
             raise FetchPointError(id)
         return x, y
-        
+
+    def get_points(self, ids):
+        """
+        Get longitude and latitude for a collection of records concurrently
+
+        :param ids: ids for the documents to decode
+        :type ids: list
+        :returns: mapping of id to (longitude, latitude); ids that fail are omitted
+        :rtype: dict
+        """
+        def fetch(id):
+            try:
+                return self.get_point(id)
+            except FetchPointError as fpe:
+                return None
+        points = {}
+        for id, point in zip(ids, self._executor.map(fetch, ids)):
+            if point is not None:
+                points[id] = point
+        return points
+
     def get_ids(self, batch=1, batch_size=10):
         query_url = '{}?page={}&per_page={}'.format(self._endpoint_url, batch, batch_size)
         try:
-            response = requests.get(query_url, headers={'Accept': 'application/json'})
-            json_data = json.loads(response.text)
-        except requests.exceptions.ConnectionError as ce:
+            response = self._session.get(query_url, timeout=_TIMEOUT)
+            if orjson is not None:
+                json_data = orjson.loads(response.content)
+            else:
+                json_data = json.loads(response.text)
+        except requests.exceptions.RequestException as ce:
             raise FetchIdBatchError(query_url)
         return [item[0] for item in json_data['register_items']], 'next' in response.links
 
-def write_output(file, lines):
+class ConcurrencyLimiter:
+    """ Bounds in-flight PIP requests and adapts the bound to observed latency """
+
+    def __init__(self, limit, floor=1, window=50):
+        """
+        Creator
+
+        :param limit: Maximum number of concurrent acquisitions
+        :type limit: integer
+        :param floor: Lowest bound auto-tuning may reach
+        :type floor: integer
+        :param window: Number of recent latencies kept for tuning
+        :type window: integer
+        """
+        self._ceiling = limit
+        self._limit = limit
+        self._floor = floor
+        self._active = 0
+        self._condition = threading.Condition()
+        self._latencies = deque(maxlen=window)
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self._limit:
+                self._condition.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def record(self, latency):
+        """
+        Record the latency of a completed request
+
+        :param latency: Duration of the request in seconds
+        :type latency: double
+        :return: None
+        """
+        with self._condition:
+            self._latencies.append(latency)
+
+    def adjust(self, threshold):
+        """
+        Retune the concurrency bound from recently recorded latencies
+
+        Halves the bound (down to the floor) when the median latency exceeds
+        the threshold, otherwise creeps back up towards the initial limit.
+
+        :param threshold: Median latency in seconds above which to back off
+        :type threshold: double
+        :return: None
+        """
+        with self._condition:
+            if not self._latencies:
+                return
+            latencies = sorted(self._latencies)
+            median = latencies[len(latencies) // 2]
+            if median > threshold:
+                self._limit = max(self._floor, self._limit // 2)
+            elif self._limit < self._ceiling:
+                self._limit += 1
+            self._condition.notify_all()
+
+def write_output(fp, lines):
     """
-    Write contents of a list as lines to a specified file
-    :param file: The file to write output to
-    :type file: string
-    :param lines: The lines to write to the specified file\
+    Write contents of a list as lines to an open output file
+    :param fp: The open file to write output to
+    :type fp: file
+    :param lines: The lines to write to the specified file
     :type lines: list
     :return: None
     """
-    with open(file, 'a') as file:
-        for line in lines:
-            file.write(line)
-        file.close()
-        
-def pip(row_id, point_id, sf_function):
+    fp.writelines(lines)
+
+
+def pip(row_id, point_id, point, sf_function):
     """
     Perform point in polygon search using specified Simple Features function
 
@@ -273,25 +806,63 @@ def pip(row_id, point_id, sf_function):
     :type row_id: string
     :param point_id: An identifier for the point in the index
     :type point_id: string
+    :param point: The (longitude, latitude) pair, or None when the lookup failed
+    :type point: tuple
     :param sf_function: The name of the Simple Features function e.g., Contains, Intersects
-    :return: None
+    :return: CSV row linking the identifiers
+    :rtype: string
     """
-    try:
-        x, y = point_model.get_point(point_id)
+    if point is None:
+        row = '{},{},{}\n'.format(row_id, point_id, "POINTFAIL")
+        print(row)
+        return row
+    with inflight_limiter:
+        started = time.monotonic()
         try:
-            id = polygon_model.obtain_id(x=x, y=y, sf_function=sf_function)
+            id = polygon_model.obtain_id(x=point[0], y=point[1], sf_function=sf_function)
             row = '{},{},{}\n'.format(row_id, point_id, id)
         except PIPError as pe:
             row = '{},{},{}\n'.format(row_id, point_id, "PIPFAIL")
             print(row)
-    except FetchPointError as fpe:
-        row = '{},{},{}\n'.format(row_id, point_id, "POINTFAIL")
-        print(row)
-    while global_lock.locked():
-        continue
-    global_lock.acquire()
-    cache.append(row)
-    global_lock.release()
+        inflight_limiter.record(time.monotonic() - started)
+    return row
+
+def pip_many(tasks, sf_function):
+    """
+    Perform point in polygon searches for a chunk of points with one WFS request
+
+    :param tasks: (row_id, point_id, point) triples where point is a
+        (longitude, latitude) pair or None when the lookup failed
+    :type tasks: list
+    :param sf_function: The name of the Simple Features function e.g., Contains, Intersects
+    :return: CSV rows linking the identifiers
+    :rtype: list
+    """
+    rows = []
+    points = [
+        (point_id, point[0], point[1])
+        for row_id, point_id, point in tasks if point is not None
+    ]
+    failed = False
+    with inflight_limiter:
+        started = time.monotonic()
+        try:
+            ids = polygon_model.obtain_ids(points=points, sf_function=sf_function)
+        except PIPError as pe:
+            ids = {}
+            failed = True
+        inflight_limiter.record(time.monotonic() - started)
+    for row_id, point_id, point in tasks:
+        if point is None:
+            row = '{},{},{}\n'.format(row_id, point_id, "POINTFAIL")
+            print(row)
+        elif failed:
+            row = '{},{},{}\n'.format(row_id, point_id, "PIPFAIL")
+            print(row)
+        else:
+            row = '{},{},{}\n'.format(row_id, point_id, ids.get(point_id))
+        rows.append(row)
+    return rows
 
 if __name__ == "__main__":
 
@@ -311,40 +882,71 @@ if __name__ == "__main__":
     batch_stop = int(config['DEFAULT']['stop'])
     output_file = config['DEFAULT']['output_file']
     threads = int(config['DEFAULT']['threads'])
+    pip_batch = int(config['DEFAULT']['pip_batch'])
+    max_inflight = int(config['DEFAULT']['max_inflight'])
+    latency_threshold = float(config['DEFAULT']['latency_threshold'])
     i = int(config['DEFAULT']['batch_id'])
 
     model = getattr(sys.modules[__name__], register_model)
     point_model = model(endpoint=register_endpoint)
     polygon_model = WFSModel(
         ns_short=ns_short, ns_url=ns_url, url=url, layer=layer,
-        geometry_field=geometry_field, layer_id=layer_id
+        geometry_field=geometry_field, layer_id=layer_id, pool_size=threads,
+        sf_function=function
     )
 
-    loop = True
-
-    global_lock = threading.Lock()
-    cache = None
+    executor = ThreadPoolExecutor(max_workers=threads)
+    inflight_limiter = ConcurrencyLimiter(limit=max_inflight)
+    out_fp = open(output_file, 'a', buffering=1<<20)
 
-    while batch_start < batch_stop and loop:
-        try:
-            identifiers, loop = point_model.get_ids(batch=batch_start, batch_size=batch_size)
+    try:
+        for identifiers in point_model.iter_ids(
+                batch=batch_start, batch_size=batch_size, stop=batch_stop
+        ):
+            try:
+                points = point_model.get_points(identifiers)
+            except FetchPointError as fpe:
+                points = {}
             records = len(identifiers)
             indexer = 0
-            while indexer < records:
-                cache = []
-                processing_threads = []
-                iterations = threads
-                remainder = records - indexer
-                if remainder < iterations:
-                    iterations = remainder
-                for counter in range(1, iterations+1):
-                    t = threading.Thread(target=pip, args=[i, identifiers[indexer], function])
-                    processing_threads.append(t)
-                    t.start()
-                    i += 1
-                    indexer += 1
-                [thread.join() for thread in processing_threads]
-                write_output(output_file, cache)
-        except FetchIdBatchError as id_error:
-            print(id_error.message)
-        batch_start += 1
+            if pip_batch > 1:
+                chunks = []
+                while indexer < records:
+                    iterations = pip_batch
+                    remainder = records - indexer
+                    if remainder < iterations:
+                        iterations = remainder
+                    chunks.append([
+                        (
+                            i + counter, identifiers[indexer + counter],
+                            points.get(identifiers[indexer + counter])
+                        )
+                        for counter in range(iterations)
+                    ])
+                    i += iterations
+                    indexer += iterations
+                for cache in executor.map(lambda chunk: pip_many(chunk, function), chunks):
+                    write_output(out_fp, cache)
+            else:
+                while indexer < records:
+                    iterations = threads
+                    remainder = records - indexer
+                    if remainder < iterations:
+                        iterations = remainder
+                    tasks = [
+                        (
+                            i + counter, identifiers[indexer + counter],
+                            points.get(identifiers[indexer + counter]), function
+                        )
+                        for counter in range(iterations)
+                    ]
+                    cache = list(executor.map(lambda args: pip(*args), tasks))
+                    i += iterations
+                    indexer += iterations
+                    write_output(out_fp, cache)
+            inflight_limiter.adjust(latency_threshold)
+    except FetchIdBatchError as id_error:
+        print(id_error)
+    finally:
+        out_fp.close()
+        executor.shutdown()
@@ -3,8 +3,12 @@ import joiner
 import pytest
 from mock import patch
 import requests
-import xml.etree.ElementTree as ET
 import configparser
+import io
+from concurrent.futures import Future
+
+class RawResponse(io.BytesIO):
+    """ BytesIO accepting the decode_content attribute set on streamed responses """
 
 class TestWFSModel:
 
@@ -30,6 +34,29 @@ class TestWFSModel:
     _LATITUDE=-35.20113263
     _LONGITUDE=149.03865604
     _FUNCTION='Contains'
+    _BATCH_RESULT_XML=(
+        '<?xml version="1.0" encoding="UTF-8"?><wfs:FeatureCollection xmlns="http://www.opengis.net/wfs" xmlns:wfs="http://www.opengis.net/wfs" xmlns:ahgf_shcatch="http://linked.data.gov.au/dataset/geof/v2/ahgf_shcatch" xmlns:gml="http://www.opengis.net/gml">'
+        '<gml:featureMember><ahgf_shcatch:AHGFCatchment fid="AHGFCatchment.1">'
+        '<ahgf_shcatch:hydroid>1111</ahgf_shcatch:hydroid>'
+        '<ahgf_shcatch:shape><gml:Polygon srsName="EPSG:4283"><gml:outerBoundaryIs><gml:LinearRing>'
+        '<gml:coordinates>0.0,0.0 1.0,0.0 1.0,1.0 0.0,1.0 0.0,0.0</gml:coordinates>'
+        '</gml:LinearRing></gml:outerBoundaryIs><gml:innerBoundaryIs><gml:LinearRing>'
+        '<gml:coordinates>0.4,0.4 0.6,0.4 0.6,0.6 0.4,0.6 0.4,0.4</gml:coordinates>'
+        '</gml:LinearRing></gml:innerBoundaryIs></gml:Polygon></ahgf_shcatch:shape>'
+        '</ahgf_shcatch:AHGFCatchment></gml:featureMember>'
+        '<gml:featureMember><ahgf_shcatch:AHGFCatchment fid="AHGFCatchment.2">'
+        '<ahgf_shcatch:hydroid>2222</ahgf_shcatch:hydroid>'
+        '<ahgf_shcatch:shape><gml:MultiPolygon srsName="EPSG:4283">'
+        '<gml:polygonMember><gml:Polygon><gml:outerBoundaryIs><gml:LinearRing>'
+        '<gml:coordinates>2.0,2.0 3.0,2.0 3.0,3.0 2.0,3.0 2.0,2.0</gml:coordinates>'
+        '</gml:LinearRing></gml:outerBoundaryIs></gml:Polygon></gml:polygonMember>'
+        '<gml:polygonMember><gml:Polygon><gml:outerBoundaryIs><gml:LinearRing>'
+        '<gml:coordinates>4.0,4.0 5.0,4.0 5.0,5.0 4.0,5.0 4.0,4.0</gml:coordinates>'
+        '</gml:LinearRing></gml:outerBoundaryIs></gml:Polygon></gml:polygonMember>'
+        '</gml:MultiPolygon></ahgf_shcatch:shape>'
+        '</ahgf_shcatch:AHGFCatchment></gml:featureMember>'
+        '</wfs:FeatureCollection>'
+    )
 
     @pytest.fixture(scope="class")
     def wfs_polygon_model(self):
@@ -39,17 +66,60 @@ class TestWFSModel:
         )
         yield wfs
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_obtain_id(self, mock_requests_get, wfs_polygon_model):
-        mock_requests_get.return_value.text = self._RESULT_XML
+        mock_response = mock_requests_get.return_value.__enter__.return_value
+        mock_response.raw = RawResponse(self._RESULT_XML.encode('utf-8'))
         id = wfs_polygon_model.obtain_id(
             x=self._LONGITUDE, y=self._LATITUDE, sf_function=self._FUNCTION
         )
         assert id == self._ID
-        mock_requests_get.side_effect = ET.ParseError
+        id = wfs_polygon_model.obtain_id(
+            x=self._LONGITUDE, y=self._LATITUDE, sf_function=self._FUNCTION
+        )
+        assert id == self._ID
+        assert mock_requests_get.call_count == 1
+        mock_response.raw = RawResponse(b'NOT XML')
         with pytest.raises(joiner.PIPError):
             id = wfs_polygon_model.obtain_id(
-                x=self._LONGITUDE, y=self._LATITUDE, sf_function=self._FUNCTION
+                x=self._LONGITUDE + 1, y=self._LATITUDE, sf_function=self._FUNCTION
+            )
+
+    @patch('requests.Session.get')
+    def test_obtain_id_single_flight(self, mock_requests_get, wfs_polygon_model):
+        x = self._LONGITUDE + 2
+        future = Future()
+        future.set_result(self._ID)
+        key = (round(x, 6), round(self._LATITUDE, 6), self._FUNCTION)
+        wfs_polygon_model._inflight[key] = future
+        id = wfs_polygon_model.obtain_id(
+            x=x, y=self._LATITUDE, sf_function=self._FUNCTION
+        )
+        assert id == self._ID
+        assert mock_requests_get.call_count == 0
+        del wfs_polygon_model._inflight[key]
+
+    @patch('requests.Session.get')
+    def test_obtain_ids(self, mock_requests_get, wfs_polygon_model):
+        mock_response = mock_requests_get.return_value.__enter__.return_value
+        mock_response.raw = RawResponse(self._BATCH_RESULT_XML.encode('utf-8'))
+        ids = wfs_polygon_model.obtain_ids(
+            points=[
+                ('p1', 0.2, 0.2), ('p2', 0.5, 0.5), ('p3', 2.5, 2.5), ('p4', 4.5, 4.5)
+            ],
+            sf_function=self._FUNCTION
+        )
+        assert ids == {'p1': '1111', 'p2': None, 'p3': '2222', 'p4': '2222'}
+        assert mock_requests_get.call_count == 1
+        ids = wfs_polygon_model.obtain_ids(
+            points=[('p1', 0.2, 0.2), ('p4', 4.5, 4.5)], sf_function=self._FUNCTION
+        )
+        assert ids == {'p1': '1111', 'p4': '2222'}
+        assert mock_requests_get.call_count == 1
+        mock_response.raw = RawResponse(b'NOT XML')
+        with pytest.raises(joiner.PIPError):
+            ids = wfs_polygon_model.obtain_ids(
+                points=[('p5', 7.0, 7.0), ('p6', 8.0, 8.0)], sf_function=self._FUNCTION
             )
 
 
@@ -118,6 +188,22 @@ class TestDBModel:
         with pytest.raises(joiner.FetchPointError):
             x, y = db_model.get_point(id=self._ID, select_statement=self._RETURN_ONE_QUERY)
 
+    @patch('joiner.DBModel.run_query')
+    def test_get_points(
+            self, mock_run_query, db_model
+    ):
+        mock_run_query.return_value = [(self._ID, self._LONGITUDE, self._LATITUDE)]
+        points = db_model.get_points(ids=[self._ID], select_statement=self._RETURN_ONE_QUERY)
+        mock_run_query.assert_called_once_with(
+            query=self._RETURN_ONE_QUERY, parameters=([self._ID],)
+        )
+        assert points == {self._ID: (self._LONGITUDE, self._LATITUDE)}
+        mock_run_query.side_effect = Exception
+        with pytest.raises(joiner.FetchPointError):
+            points = db_model.get_points(
+                ids=[self._ID], select_statement=self._RETURN_ONE_QUERY
+            )
+
 
 class TestLDAPIModel:
 
@@ -203,11 +289,12 @@ class TestLDAPIModel:
         (['next', 'prev', 'first', 'last'], True),
         (['prev', 'first', 'last'], False)
     ])
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_get_ids(
             self, mock_get, links, more, api_model
     ):
         mock_get.return_value.text = self._GET_RESULT
+        mock_get.return_value.content = self._GET_RESULT.encode('utf-8')
         mock_get.return_value.links = links
         rows, more_records = api_model.get_ids(
             batch=self._BATCH, batch_size=self._BATCH_SIZE
@@ -219,7 +306,7 @@ class TestLDAPIModel:
                 batch=self._BATCH, batch_size=self._BATCH_SIZE
             )
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_get_point(
             self, mock_get, api_model
     ):
@@ -230,3 +317,49 @@ class TestLDAPIModel:
         mock_get.side_effect = requests.exceptions.ConnectionError
         with pytest.raises(joiner.FetchPointError):
             x, y = api_model.get_point(id=self._ID)
+
+    @patch('requests.Session.get')
+    def test_get_points(
+            self, mock_get, api_model
+    ):
+        mock_get.return_value.text = self._ID_RESULT
+        points = api_model.get_points(ids=[self._ID])
+        assert points == {self._ID: (self._LONGITUDE, self._LATITUDE)}
+        mock_get.side_effect = requests.exceptions.ConnectionError
+        assert api_model.get_points(ids=[self._ID]) == {}
+
+    @patch('joiner.LDAPIModel.get_ids')
+    def test_iter_ids(
+            self, mock_get_ids, api_model
+    ):
+        mock_get_ids.side_effect = [([1, 2], True), ([3, 4], True), ([5], False)]
+        batches = list(api_model.iter_ids(batch=1, batch_size=2))
+        assert batches == [[1, 2], [3, 4], [5]]
+        mock_get_ids.side_effect = [
+            ([1, 2], True), joiner.FetchIdBatchError('page'), ([5], False)
+        ]
+        batches = list(api_model.iter_ids(batch=1, batch_size=2))
+        assert batches == [[1, 2], [5]]
+        mock_get_ids.side_effect = [([1, 2], True), ([3, 4], True)]
+        batches = list(api_model.iter_ids(batch=1, batch_size=2, stop=2))
+        assert batches == [[1, 2]]
+
+
+class TestConcurrencyLimiter:
+
+    _LIMIT=4
+    _THRESHOLD=1.0
+
+    def test_adjust(self):
+        limiter = joiner.ConcurrencyLimiter(limit=self._LIMIT)
+        with limiter:
+            pass
+        limiter.adjust(self._THRESHOLD)
+        assert limiter.limit == self._LIMIT
+        limiter.record(self._THRESHOLD * 2)
+        limiter.adjust(self._THRESHOLD)
+        assert limiter.limit == self._LIMIT // 2
+        limiter.record(self._THRESHOLD / 2)
+        limiter.record(self._THRESHOLD / 2)
+        limiter.adjust(self._THRESHOLD)
+        assert limiter.limit == self._LIMIT // 2 + 1